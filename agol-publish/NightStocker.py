@@ -1,60 +1,193 @@
+import concurrent.futures
 import csv
 import datetime
+import functools
 import getpass
+import itertools
 import json
+import math
+import mmap
 import os
-import pprint
 import pygsheets
 import shutil
 import sys
 import tempfile
+import threading
+import time
 import traceback
 from re import sub
 
 import arcgis
 import arcpy
+import requests
+from googleapiclient.errors import HttpError
 
 import settings as s
 
 
-def project_data(sgid_table, fgdb_folder, fgdb, is_table):
+_WEB_MERCATOR = arcpy.SpatialReference(3857)
+_TRANSFORMATION = 'NAD_1983_to_WGS_1984_5'
+
+#: Compact the temp fgdb after this many projected layers so the space from
+#: deleted tables is reclaimed and writes don't slow down over a long run
+_COMPACT_INTERVAL = 25
+
+SHELVED_DISCLAIMER = '<i><b>NOTE</b>: This dataset is an older dataset that we have removed from the SGID and \'shelved\' in ArcGIS Online. There may (or may not) be a newer vintage of this dataset in the SGID.</i>'
+
+STATIC_DISCLAIMER = '<i><b>NOTE</b>: This dataset holds \'static\' data that we don\'t expect to change. We have removed it from the SDE database and placed it in ArcGIS Online, but it is still considered part of the SGID and shared on opendata.gis.utah.gov.</i>'
+
+
+def agol_title(title):
+    '''Get the title an item is published to AGOL with: the title from the
+    layer list, with 'Utah' prepended if it doesn't already start with it.
+
+    Parameters:
+    title: item title from the layer list csv
+
+    returns: AGOL item title
+    '''
+    if not title.startswith('Utah'):
+        title = f'Utah {title}'
+    return title
+
+
+def project_data(sgid_table, fgdb_folder, fgdb, describe):
     '''Project a feature class from SDE into web mercator. 
-    Non-spatial tables are just copied over as-is.
+    Feature classes that are already in web mercator are just copied over
+    as-is. Tables are never uploaded, so they aren't handled here.
 
     Parameters: 
     sgid_table: source table
     fgdb_folder: temp folder path
-    fgdb: temp fgdb name
-    is_table: boolean to flag if sgid_table is just tabular (non-spatial)
+    fgdb: temp fgdb name (must already exist)
+    describe: results of arcpy.da.Describe() on sgid_table
 
     returns: path to projected data 
     '''
-    web_mercator = arcpy.SpatialReference(3857)
-    transformation = 'NAD_1983_to_WGS_1984_5'
-    
     name = sgid_table.split(os.path.sep)[-1].replace('.', '_')
     output_table = os.path.join(fgdb_folder, fgdb, name)
 
-    if not arcpy.Exists(os.path.join(fgdb_folder, fgdb)):
-        #: create fgdb if it's missing
-        print(f'creating {fgdb}')
-        arcpy.management.CreateFileGDB(fgdb_folder, fgdb)
-
     #: Delete the feature class if it already exists. Don't use scratch for
     #: long-term storage.
     if arcpy.Exists(output_table):
         arcpy.Delete_management(output_table)
 
     print('importing/projecting data')
-    if is_table:
+    if describe['spatialReference'].factoryCode == 3857:
         arcpy.management.Copy(sgid_table, output_table)
     else:
-        arcpy.management.Project(sgid_table, output_table, web_mercator,
-                                 transformation)
+        arcpy.management.Project(sgid_table, output_table, _WEB_MERCATOR,
+                                 _TRANSFORMATION)
 
     return output_table
 
 
+def configure_session(gis, pool_size, host_pools=16):
+    '''Size the connection pool of the ArcGIS API's requests session so AGOL
+    calls (uploads, publish, share, update, etc.) reuse keep-alive
+    connections, with enough connections for all the publishing and upload
+    threads.
+
+    If the installed ArcGIS API doesn't expose its session, a warning is
+    printed and a separate session is returned. That session is only used
+    for multipart uploads; the API's own calls aren't pooled.
+
+    Parameters:
+    gis: An ArcGIS API gis item.
+    pool_size: maximum number of connections to keep open per host
+    host_pools: number of hosts to keep connection pools for
+
+    returns: the requests.Session to use for multipart uploads
+    '''
+    session = getattr(gis._con, '_session', None)
+    if session is None:
+        print('WARNING: the ArcGIS API has no requests session to configure; '
+              'only multipart uploads will use pooled connections')
+        session = requests.Session()
+
+    adapter = requests.adapters.HTTPAdapter(pool_connections=host_pools,
+                                            pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def add_item_multipart(gis, service_definition, part_size, threads,
+                       session, commit_timeout):
+    '''Upload a file to the user's root AGOL folder in parts using the
+    addItem/addPart/commit REST calls, sending several parts at once.
+
+    Parameters:
+    gis: An ArcGIS API gis item.
+    service_definition: path to a service definition file created in ArcGIS Pro
+    part_size: size in bytes of each uploaded part (a multiple of 8 KiB)
+    threads: number of parts to upload concurrently
+    session: requests.Session to send the parts with
+    commit_timeout: seconds to wait for AGOL to finish putting the parts
+                    together before giving up
+
+    returns: the uploaded service definition item
+    '''
+    user_url = f'{gis._portal.resturl}content/users/{gis.users.me.username}'
+    token = gis._con.token
+    file_name = os.path.basename(service_definition)
+
+    with open(service_definition, 'rb') as sd_file, \
+         mmap.mmap(sd_file.fileno(), 0, access=mmap.ACCESS_READ) as sd_map:
+
+        def call(method, url, data=None, files=None):
+            params = {'f': 'json', 'token': token}
+            try:
+                if method == 'get':
+                    response = session.get(url, params=params)
+                else:
+                    response = session.post(url, data={**params, **data},
+                                            files=files)
+                response.raise_for_status()
+            except requests.RequestException as error:
+                raise RuntimeError(f'Error uploading {file_name}: {error}') from error
+            result = response.json()
+            if 'error' in result:
+                raise RuntimeError(f'Error uploading {file_name}: {result["error"]}')
+            return result
+
+        item_id = call('post', f'{user_url}/addItem', {
+            'multipart': 'true',
+            'filename': file_name,
+            'type': 'Service Definition',
+            'title': os.path.splitext(file_name)[0]
+            })['id']
+        item_url = f'{user_url}/items/{item_id}'
+
+        def add_part(part_num):
+            offset = (part_num - 1) * part_size
+            part = sd_map[offset:offset + part_size]
+            call('post', f'{item_url}/addPart', {'partNum': part_num},
+                 files={'file': (file_name, part)})
+
+        part_count = math.ceil(len(sd_map) / part_size)
+        print(f'uploading {part_count} parts')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(add_part, range(1, part_count + 1)))
+
+        call('post', f'{item_url}/commit', {'type': 'Service Definition'})
+
+        #: Commit is asynchronous; wait for AGOL to put the parts together.
+        #: Anything other than a known in-progress status ends the wait.
+        deadline = time.monotonic() + commit_timeout
+        status = call('get', f'{item_url}/status')
+        while status.get('status') in ('partial', 'processing'):
+            if time.monotonic() > deadline:
+                raise RuntimeError(f'Error uploading {file_name}: commit still '
+                                   f'{status["status"]} after {commit_timeout} seconds')
+            time.sleep(2)
+            status = call('get', f'{item_url}/status')
+        if status.get('status') != 'completed':
+            raise RuntimeError(f'Error uploading {file_name}: {status.get("statusMessage", status)}')
+
+    return gis.content.get(item_id)
+
+
 def upload_layer(gis, service_definition, info, protect=True):
     '''Upload a service definition file to AGOL and publish it as a
     Hosted Feature Layer, setting appropriate information.
@@ -77,7 +210,12 @@ def upload_layer(gis, service_definition, info, protect=True):
     '''
 
     print("uploading")
-    sd_item = gis.content.add({}, data=service_definition)
+    if os.path.getsize(service_definition) > s.UPLOAD_PART_SIZE:
+        sd_item = add_item_multipart(gis, service_definition,
+                                     s.UPLOAD_PART_SIZE, s.UPLOAD_THREADS,
+                                     agol_session, s.UPLOAD_COMMIT_TIMEOUT)
+    else:
+        sd_item = gis.content.add({}, data=service_definition)
 
     #: Publishing
     print("publishing")
@@ -114,74 +252,74 @@ def upload_layer(gis, service_definition, info, protect=True):
     return published_item.itemid
 
 
-def create_service_definition(layer_info, sde_path, temp_dir, project_path, 
-                              map_name, describe):
-    '''Create a service defintion for a layer to be uploaded to AGOL from an
-    SDE using an existing ArcGIS Pro project.
+def create_service_definition(layer_info, projected_table, temp_dir, proj,
+                              agol_map, empty_map_cim, describe):
+    '''Create a service defintion for a layer to be uploaded to AGOL from
+    data projected out of the SDE. The sharing draft is made straight from a
+    feature layer; if that fails, the layer is added to a map in an existing
+    ArcGIS Pro project and the draft is made from there instead. The draft is
+    staged once either way.
     
     Parameters:
     layer_info: Dictionary of info about the layer to be prepped for upload
         fc_name: Fully qualified name of the SDE feature class to be uploaded 
                  (string)
         title: title of the item for AGOL (string)
-    sde_path: Path to the source .sde connection file
+    projected_table: Path to the layer's data from project_data()
     temp_dir: Directory for holding reprojected fgdb and .sddraft & .sd files
-    project_path: Path to an existing ArcGIS Pro project
-    map_name: Name of the map in the Pro project to use
+    proj: An open arcpy.mp.ArcGISProject, reused across layers
+    agol_map: The map in proj to use for publishing
+    empty_map_cim: CIM definition of agol_map with no layers or tables and a
+                   web mercator spatial reference
     describe: results of arcpy.da.Describe() on feature class
 
     returns: path to the .sd file
     '''
 
+    layer = None
+    layer_name = layer_info['fc_name'].split('.')[-1]
     try:
         start = datetime.datetime.now()
 
-        sgid_table = os.path.join(sde_path, layer_info['fc_name'])
         is_table = describe['datasetType'] == 'Table'
 
-        projected_table = project_data(sgid_table, temp_dir, 'tempfgdb.gdb',
-                                       is_table)
-
-        #: Get project and map
-        proj = arcpy.mp.ArcGISProject(project_path)
-        for m in proj.listMaps():
-            if m.name == map_name:
-                agol_map = m
-        del m
-
-        #: Remove any existing layers
-        for l in agol_map.listLayers():
-            agol_map.removeLayer(l)
-        for t in agol_map.listTables():
-            agol_map.removeTable(t)
-
-        # : Add layer
-        layer = agol_map.addDataFromPath(projected_table)
-        layer.name = layer_info['fc_name'].split('.')[-1]
-
-        #: Verify map projection
-        cim = agol_map.getDefinition('V2')
-        if cim.spatialReference['wkid'] != 3857:
-            print('changing map projection')
-            cim.spatialReference = {'wkid':3857}
-            agol_map.setDefinition(cim)
-        else:
-            cim = None
-
-        proj.save()
-
-        item_name = layer_info['title']
-        if not item_name.startswith('Utah'):
-            item_name = f'Utah {item_name}'
+        item_name = agol_title(layer_info['title'])
 
         #: Staging
         print("staging")
         draft_path = os.path.join(temp_dir, f'{item_name}.sddraft')
         sd_path = draft_path[:-5]
-        sharing_draft = agol_map.getWebLayerSharingDraft('HOSTING_SERVER',
-                                                         'FEATURE', item_name,
-                                                         [layer])
-        sharing_draft.exportToSDDraft(draft_path)
+        #: Only building the draft falls back to the map; a staging error is a
+        #: real problem with the data and is passed up as-is
+        try:
+            feature_layer = arcpy.management.MakeFeatureLayer(projected_table, layer_name)[0]
+            sharing_draft = arcpy.sharing.CreateSharingDraft('HOSTING_SERVER',
+                                                             'FEATURE', item_name,
+                                                             feature_layer)
+            sharing_draft.exportToSDDraft(draft_path)
+        except (arcpy.ExecuteError, RuntimeError, ValueError) as error:
+            print(f'could not create draft directly from layer ({error}); using {agol_map.name}')
+
+            #: Don't let a partial draft from the first attempt get in the way
+            if os.path.exists(draft_path):
+                os.remove(draft_path)
+
+            #: Reset the map to its empty, web mercator state in one step
+            #: rather than removing any leftover layers one at a time
+            agol_map.setDefinition(empty_map_cim)
+
+            # : Add layer
+            layer = agol_map.addDataFromPath(projected_table)
+            layer.name = layer_name
+
+            sharing_draft = agol_map.getWebLayerSharingDraft('HOSTING_SERVER',
+                                                             'FEATURE', item_name,
+                                                             [layer])
+            sharing_draft.exportToSDDraft(draft_path)
+        finally:
+            if arcpy.Exists(layer_name):
+                arcpy.management.Delete(layer_name)
+
         arcpy.server.StageService(draft_path, sd_path)
 
         end = datetime.datetime.now()
@@ -204,19 +342,21 @@ def create_service_definition(layer_info, sde_path, temp_dir, project_path,
         #: delete the fgdb itself.
 
         if layer and not is_table:
-            layer.updateConnectionProperties(os.path.join(temp_dir, 'tempfgdb.gdb'), r'c:\foo\bar.gdb', auto_update_joins_and_relates=False, validate=False)
+            layer.updateConnectionProperties(os.path.dirname(projected_table), r'c:\foo\bar.gdb', auto_update_joins_and_relates=False, validate=False)
 
             agol_map.removeLayer(layer)
+
+        #: Only save if the project was used, after the layer's been cleared
+        #: out of the map
+        if layer:
             proj.save()
 
         # layer = None
-        # cim = None
         # agol_map = None
         # proj = None
         # sharing_draft = None
 
         # del layer
-        # del cim
         # del agol_map
         # del proj
         # del sharing_draft
@@ -231,6 +371,65 @@ def create_service_definition(layer_info, sde_path, temp_dir, project_path,
     return sd_path
 
 
+class MetadataStore:
+    '''Look up feature class metadata from the metadata json file by the
+    feature class's short name. Only the entries that are asked for are
+    parsed and kept in memory (streaming the file needs ijson).
+
+    Parameters:
+    path: path to the metadata json file ({fc name: {metadata}}); names may
+          be short ('Counties') or fully qualified ('SGID.BOUNDARIES.Counties')
+    preload: if True, parse the whole file up front instead (faster if most
+             feature classes will be looked up)
+    '''
+
+    def __init__(self, path, preload=False):
+        self._path = path
+        self._cache = {}
+
+        if preload:
+            with open(path, 'r') as meta_file:
+                self._cache = {name.split('.')[-1]: metadata
+                               for name, metadata in json.load(meta_file).items()}
+
+    def get(self, key):
+        '''Get the metadata for a feature class, streaming through the file
+        until it's found if it hasn't been looked up before.
+
+        Parameters:
+        key: feature class short name, without the database/owner prefix
+
+        returns: dict of metadata; raises KeyError if key isn't in the file
+        '''
+        if key not in self._cache:
+            #: Only needed for streaming lookups, so preloading works without it
+            import ijson
+
+            with open(self._path, 'rb') as meta_file:
+                for name, metadata in ijson.kvitems(meta_file, ''):
+                    if name.split('.')[-1] == key:
+                        self._cache[key] = metadata
+                        break
+                else:
+                    raise KeyError(key)
+
+        return self._cache[key]
+
+
+@functools.lru_cache(maxsize=None)
+def fc_tokens(fc_name):
+    '''Split a fully-qualified feature class name into its category and
+    short name: 'SGID.BOUNDARIES.Counties' -> ('Boundaries', 'Counties')
+
+    Parameters:
+    fc_name: Fully qualified name of the SDE feature class
+
+    returns: tuple of (title-cased category, feature class name)
+    '''
+    parts = fc_name.split('.')
+    return parts[-2].title(), parts[-1]
+
+
 def get_info(entry, generic_terms_of_use):
     '''Get the info needed for publishing AGOL item.
     
@@ -241,11 +440,11 @@ def get_info(entry, generic_terms_of_use):
     
     returns: dict of relevant information
     '''
-    category = entry[0].split('.')[-2].title()
+    category, short_name = fc_tokens(entry[0])
     credit = entry[2] if entry[2] else 'AGRC'
     
     #: Get metadata for this specific featureclass
-    metadata = metadata_lookup[entry[0].split('.')[-1]]
+    metadata = metadata_store.get(short_name)
 
     #: Get tags, ensuring AGRC and SGID are in the list
     base_tags = ['AGRC', 'SGID']
@@ -259,10 +458,6 @@ def get_info(entry, generic_terms_of_use):
 
     description = metadata['description']
 
-    shelved_disclaimer = '<i><b>NOTE</b>: This dataset is an older dataset that we have removed from the SGID and \'shelved\' in ArcGIS Online. There may (or may not) be a newer vintage of this dataset in the SGID.</i>'
-
-    static_disclaimer = '<i><b>NOTE</b>: This dataset holds \'static\' data that we don\'t expect to change. We have removed it from the SDE database and placed it in ArcGIS Online, but it is still considered part of the SGID and shared on opendata.gis.utah.gov.</i>'
-
     if metadata['licenseInfo']:
         terms = metadata['licenseInfo']
     else:
@@ -272,13 +467,13 @@ def get_info(entry, generic_terms_of_use):
         group = 'AGRC Shelf'
         tags.append('shelved')
         folder = 'AGRC_Shelved'
-        description = f'{shelved_disclaimer} <p> </p> <p>{description}</p>'
+        description = f'{SHELVED_DISCLAIMER} <p> </p> <p>{description}</p>'
     elif entry[3] == 'static':
         group = f'Utah SGID {category}'
         tags.append('static')
         tags.append(category)
         folder = category
-        description = f'{static_disclaimer} <p> </p> <p>{description}</p>'
+        description = f'{STATIC_DISCLAIMER} <p> </p> <p>{description}</p>'
     else:
         raise ValueError(f'Unknown shelving category: {entry[3]}')
 
@@ -296,8 +491,43 @@ def get_info(entry, generic_terms_of_use):
     return item_info
 
 
+@functools.lru_cache(maxsize=None)
+def open_gsheets(gsheet_auth, gsheet_keys):
+    '''Authorize against Google Sheets and open the stewardship and AGOL items
+    worksheets. Cached so that authorization and indexing the stewardship
+    rows only happens once per run.
+
+    Parameters:
+    gsheet_auth: path to Google sheets authorization file
+    gsheet_keys: Tuple of keys to stewardship doc [0] and agol items doc [1]
+
+    returns: tuple of (stewardship worksheet, agol items worksheet,
+             {SGID Data Layer: [row numbers]})
+    '''
+
+    client = pygsheets.authorize(service_file=gsheet_auth)
+    stewardship_worksheet = client.open_by_key(gsheet_keys[0])[1]  #: Stewardship sheet is second tab
+    agol_worksheet = client.open_by_key(gsheet_keys[1])[0]
+
+    #: Only pull the SGID Data Layer column (C) to find rows by; the full row
+    #: is fetched when it's actually needed
+    row_index = {}
+    for i, data_layer in enumerate(stewardship_worksheet.get_col(3)):
+        row_index.setdefault(data_layer, []).append(i+1)
+
+    return stewardship_worksheet, agol_worksheet, row_index
+
+
+#: Sheets writes are queued by log_gsheets() and sent in as few requests as
+#: possible by flush_gsheets() once all the layers have been processed
+pending_stewardship_updates = []  #: [(start cell, row values), ...]
+pending_stewardship_rows = []
+pending_agol_rows = []
+
+
 def log_gsheets(action_info, gsheet_auth=None, gsheet_keys=None):
-    '''Document actions to stewardship doc.
+    '''Document actions to stewardship doc. Writes are queued until
+    flush_gsheets() is called.
     
     Parameters:
     action_info: a list of info relevant to a single feature class
@@ -311,16 +541,9 @@ def log_gsheets(action_info, gsheet_auth=None, gsheet_keys=None):
 
     updated_row = None
 
-    client = pygsheets.authorize(service_file=gsheet_auth)
-
-    #: Update stewardship doc
-    sheet = client.open_by_key(gsheet_keys[0])
-    worksheet = sheet[1]  #: Stewardship sheet is second tab
+    worksheet, agol_worksheet, row_index = open_gsheets(gsheet_auth,
+                                                        gsheet_keys)
 
-    #: Get all rows so we can work locally before update_values()
-    rows = []
-    for row in worksheet:
-        rows.append(row)
     #: Row Structure:
     #: [0 Issue, 1 Authoritative Access From, 2 SGID Data Layer,
     #: 3 Refresh Cycle (Days), 4 Last Update, 5 Days From Last Refresh,
@@ -336,17 +559,15 @@ def log_gsheets(action_info, gsheet_auth=None, gsheet_keys=None):
 
     updated = False
 
-    for i, row in enumerate(rows):
-        if row[2] == action_info[2]:
-            temp_row = row
-            temp_row[1] = 'AGRC AGOL'
-            temp_row[21] = action_info[6]
-            temp_row[24] = f'AGOL category: {action_info[1]} - {row[24]}'
-            rownum = i+1
-            start = f'A{rownum}'
-            worksheet.update_values(start, [temp_row])
-            updated = True
-            updated_row = rownum
+    for rownum in row_index.get(action_info[2], []):
+        temp_row = worksheet.get_row(rownum, include_tailing_empty=True)
+        temp_row[1] = 'AGRC AGOL'
+        temp_row[21] = action_info[6]
+        temp_row[24] = f'AGOL category: {action_info[1]} - {temp_row[24]}'
+        start = f'A{rownum}'
+        pending_stewardship_updates.append((start, temp_row))
+        updated = True
+        updated_row = rownum
 
     if not updated:
         print(f'{action_info[2]} not found in stewardship doc')
@@ -378,82 +599,111 @@ def log_gsheets(action_info, gsheet_auth=None, gsheet_keys=None):
         new_row.append(f'Added by NightStocker - AGOL category: {action_info[1]}')  #: Notes
         new_row.append('')  #: Deprecated
 
-        worksheet.insert_rows(worksheet.rows, values=new_row, inherit=True)
-
-
+        pending_stewardship_rows.append(new_row)
 
     #: Update list of new additions to AGOL
-    sheet = client.open_by_key(gsheet_keys[1])
-    worksheet = sheet[0]
     row = [action_info[0], action_info[7], f'https://utah.maps.arcgis.com/home/item.html/?id={action_info[7]}']
-    worksheet.insert_rows(worksheet.rows, values=row, inherit=True)
-            
+    pending_agol_rows.append(row)
 
     return updated_row
 
 
-def log_csv(action_info, log_path):
-    '''Log an action to csv. Every layer should be logged, regardless of
-    success or failure.
+def flush_gsheets(gsheet_auth=None, gsheet_keys=None):
+    '''Write all the queued stewardship updates, new stewardship rows, and
+    new AGOL item rows in one request per type. If a batched request fails,
+    fall back to writing its rows one at a time.
 
     Parameters:
-    action_info: a list of info relevant to a single feature class
-    log_path: path for logfile
+    gsheet_auth: path to Google sheets authorization file
+    gsheet_keys: Tuple of keys to stewardship doc [0] and agol items doc [1]
+    '''
+
+    if not (pending_stewardship_updates or pending_stewardship_rows
+            or pending_agol_rows):
+        return
+
+    worksheet, agol_worksheet, _ = open_gsheets(gsheet_auth, gsheet_keys)
+
+    if pending_stewardship_updates:
+        print(f'updating {len(pending_stewardship_updates)} stewardship rows')
+        try:
+            worksheet.update_values_batch(
+                [start for start, _ in pending_stewardship_updates],
+                [[row] for _, row in pending_stewardship_updates])
+        except HttpError as error:
+            print(f'Batch update failed ({error}); updating rows individually')
+            for start, row in pending_stewardship_updates:
+                worksheet.update_values(start, [row])
+        pending_stewardship_updates.clear()
+
+    for sheet, rows in ((worksheet, pending_stewardship_rows),
+                        (agol_worksheet, pending_agol_rows)):
+        if not rows:
+            continue
+        print(f'adding {len(rows)} rows to {sheet.title}')
+        try:
+            sheet.insert_rows(sheet.rows, number=len(rows), values=rows,
+                              inherit=True)
+        except HttpError as error:
+            print(f'Batch insert failed ({error}); adding rows individually')
+            for row in rows:
+                sheet.insert_rows(sheet.rows, values=row, inherit=True)
+        rows.clear()
+
+
+def compact_fgdb(fgdb_path):
+    '''Compact a file geodatabase, logging rather than raising any error so
+    that a failed compact doesn't stop the run.
+
+    Parameters:
+    fgdb_path: path to the file geodatabase
     '''
+    print(f'compacting {fgdb_path}')
     try:
-        with open(log_path, 'a', newline='\n') as logfile:
-            log_writer = csv.writer(logfile)
-            log_writer.writerow(action_info)
-    except IOError:
-        print('Error writing log file.')
+        arcpy.management.Compact(fgdb_path)
+    except arcpy.ExecuteError as error:
+        print(f'could not compact {fgdb_path}: {error}')
 
 
-sde_path = s.SDE_PATH
-project_path = s.PROJECT_PATH
-map_name = s.MAP_NAME
-list_csv = s.LIST_CSV
-terms_of_use_path = s.TERMS_OF_USE_PATH
-log_path = s.LOG_PATH
-gsheet_auth = s.GSHEET_AUTH
-stewardship_sheet_key = s.STEWARDSHIP_SHEET_KEY
-agol_sheet_key = s.AGOL_SHEET_KEY
+def describe_layers(sde_path, fc_names):
+    '''Find which of the requested datasets are tables and describe the rest
+    of them (the feature classes) in a single walk of the SDE instead of
+    looking each one up separately. Tables aren't uploaded, so they are
+    never described.
 
-#: Create a temp dir in the user's temporary directory with the pid in the 
-#: directory name. If it exists already, delete it (shelved_ prefix should be
-#: unique enough to keep us from stomping on another program's temp dir).
-temp_dir = os.path.join(tempfile.gettempdir(), f'shelved_{os.getpid()}')
-if os.path.exists(temp_dir):
-    shutil.rmtree(temp_dir)
-os.mkdir(temp_dir)
+    Parameters:
+    sde_path: Path to the source .sde connection file
+    fc_names: Fully qualified names of the datasets to describe
 
+    returns: tuple of ({fc name: arcpy.da.Describe() results},
+             set of requested names that are tables)
+    '''
+    wanted = set(fc_names)
+    describe_cache = {}
+    known_tables = set()
 
-#: Connect to AGOL
-agol_user = sys.argv[1]
-gis = arcgis.gis.GIS('https://www.arcgis.com',
-                     agol_user, 
-                     getpass.getpass(prompt=f'{agol_user}\'s password: '))
+    with arcpy.EnvManager(workspace=sde_path):
+        for _, _, filenames in arcpy.da.Walk(sde_path, datatype='Table'):
+            known_tables.update(wanted.intersection(filenames))
 
-layers = []
-with open(list_csv) as list_file:
-    reader = csv.reader(list_file)
-    # next(reader)
-    for row in reader:
-        if row[3] != 'removed': #: Just don't even add removed items to the list
-            layers.append(row)
+        for dirpath, _, filenames in arcpy.da.Walk(sde_path, datatype='FeatureClass'):
+            for filename in filenames:
+                if filename in wanted:
+                    describe_cache[filename] = arcpy.da.Describe(os.path.join(dirpath, filename))
 
-#: Get metadata for whole SDE, terms of use
-metadata_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'metadata.json')
-metadata_lookup = None
-with open(metadata_file_path, 'r') as meta_file:
-    metadata_lookup = json.loads(meta_file.read())
+    return describe_cache, known_tables
 
-with open(terms_of_use_path) as terms_file:
-    generic_terms_of_use = terms_file.read()
 
-log = []
-updated_rows = {}
+def process_entry(entry):
+    '''Describe, stage, and upload a single layer from the list csv. Safe to
+    run from multiple threads; all arcpy work is serialized on arcpy_lock.
 
-for feature_class_name, item_title, source, action in layers:
+    Parameters:
+    entry: list from CSV: [fully-qualifed FC name, fc title, credit, method]
+
+    returns: tuple of the layer's log entry and whether it was published
+    '''
+    feature_class_name, item_title, source, action = entry
     print(f'\n Starting {feature_class_name}')
 
     layer_info = {
@@ -461,40 +711,57 @@ for feature_class_name, item_title, source, action in layers:
         'title':item_title
     }
 
-    print('describing')
-    describe = arcpy.da.Describe(os.path.join(sde_path, feature_class_name))
-    is_table = describe['datasetType'] == 'Table'
+    log_entry = None
+    published = False
+    projected = False
+
     try:
+        if feature_class_name in known_tables:
+            is_table = True
+        else:
+            describe = describe_cache.get(feature_class_name)
+            if describe is None:
+                print('describing')
+                with arcpy_lock:
+                    describe = arcpy.da.Describe(os.path.join(sde_path, feature_class_name))
+            is_table = describe['datasetType'] == 'Table'
+
         #: Check if it's a table, skip if true
         if is_table:
 
             log_entry = [item_title, 'Table: not uploaded']
             print(f'{feature_class_name} is a table; not uploading')
-            log.append(log_entry)
 
-            continue
+            return log_entry, published
 
         #: Check if layer already exists in AGOL, skip if true
-        item_name = item_title  #: prepend Utah if needed to match uploaded item title
-        if not item_name.startswith('Utah'):
-            item_name = f'Utah {item_name}'
+        item_name = agol_title(item_title)  #: match uploaded item title
         existing = gis.content.search(item_name, item_type='Feature Layer')
-        skip = False
         if existing:  #: ESRI's content.search is fuzzy, need to check against each item.title
             for item in existing:
                 if item.title == item_name:
-                    skip = True
                     print(f'new title: {item_name}')
                     log_entry = [item_title, f'{feature_class_name} already published in AGOL as {item_name}: {item.itemid}']
                     print(f'{feature_class_name} already published in AGOL as {item.title}: {item.itemid}')
-                    log.append(log_entry)
-        if skip:
-            continue
-
-        print('creating sd')
-        sd_path = create_service_definition(layer_info, sde_path, 
-                                            temp_dir, project_path, 
-                                            map_name, describe)
+        if log_entry:
+            return log_entry, published
+
+        with arcpy_lock:
+            projected_table = project_data(os.path.join(sde_path, feature_class_name),
+                                           temp_dir, temp_fgdb, describe)
+            projected = True
+
+            print('creating sd')
+            sd_path = create_service_definition(layer_info, projected_table,
+                                                temp_dir, proj, agol_map,
+                                                empty_map_cim, describe)
+
+            #: Everything needed for the upload is in the .sd now; drop the
+            #: projected data so compacting has something to reclaim
+            try:
+                arcpy.management.Delete(projected_table)
+            except arcpy.ExecuteError as error:
+                print(f'could not delete {projected_table}: {error}')
 
         info_list = [feature_class_name, item_title, source, action]
         item_info = get_info(info_list, generic_terms_of_use)
@@ -509,36 +776,174 @@ for feature_class_name, item_title, source, action in layers:
         #:      description, source/credit, shape type, endpoint, AGOL item ID
         log_entry = [item_title, action, data_layer, item_info['description'],
                      item_info['credits'], shape, endpoint, item_id]
-        log.append(log_entry)
-        updated_rows[feature_class_name] = log_gsheets(log_entry, 
-                                                       gsheet_auth, 
-                                                       (stewardship_sheet_key, 
-                                                            agol_sheet_key))
-        
+        published = True
 
         #: Delete files from the scratch folder
         # sddraft = sd_path + 'draft'
         # os.remove(sd_path)
         # os.remove(sddraft)
-    except arcpy.ExecuteError:
-        message = arcpy.GetMessages()
+    except arcpy.ExecuteError as error:
+        #: arcpy.GetMessages() may already hold another thread's messages, so
+        #: use the ones attached to the error instead
+        message = str(error)
         print(message)
         log_entry = [item_title, message.replace(',', ';')]
-        log.append(log_entry)
     
     except RuntimeError as error:
         log_entry = [item_title, str(error)]
         print(f'Error with {item_title}:')
         traceback.print_exc()
 
-    finally:
-        log_csv(log_entry, log_path)
+    #: Anything else (missing metadata, an unknown shelving category, an AGOL
+    #: HTTP error, etc) only fails this layer, not the whole run
+    except Exception as error:
+        log_entry = [item_title, f'{type(error).__name__}: {error}']
+        print(f'Error with {item_title}:')
+        traceback.print_exc()
+
+    #: Compact outside the layer's error handling so a failed compact doesn't
+    #: fail a layer that was otherwise fine
+    if projected and next(projected_counter) % _COMPACT_INTERVAL == 0:
+        with arcpy_lock:
+            compact_fgdb(os.path.join(temp_dir, temp_fgdb))
+
+    return log_entry, published
+
+
+sde_path = s.SDE_PATH
+project_path = s.PROJECT_PATH
+map_name = s.MAP_NAME
+list_csv = s.LIST_CSV
+terms_of_use_path = s.TERMS_OF_USE_PATH
+log_path = s.LOG_PATH
+gsheet_auth = s.GSHEET_AUTH
+stewardship_sheet_key = s.STEWARDSHIP_SHEET_KEY
+agol_sheet_key = s.AGOL_SHEET_KEY
+
+#: Create a temp dir in the user's temporary directory with the pid in the 
+#: directory name. If it exists already, delete it (shelved_ prefix should be
+#: unique enough to keep us from stomping on another program's temp dir).
+temp_dir = os.path.join(tempfile.gettempdir(), f'shelved_{os.getpid()}')
+if os.path.exists(temp_dir):
+    shutil.rmtree(temp_dir)
+os.mkdir(temp_dir)
+
+temp_fgdb = 'tempfgdb.gdb'
+print(f'creating {temp_fgdb}')
+arcpy.management.CreateFileGDB(temp_dir, temp_fgdb)
+projected_counter = itertools.count(1)
+
+
+#: Connect to AGOL
+agol_user = sys.argv[1]
+gis = arcgis.gis.GIS('https://www.arcgis.com',
+                     agol_user, 
+                     getpass.getpass(prompt=f'{agol_user}\'s password: '))
+agol_session = configure_session(gis, s.PUBLISH_WORKERS * s.UPLOAD_THREADS)
+
+with open(list_csv, newline='') as list_file:
+    reader = csv.reader(list_file)
+    # next(reader)
+    #: Just don't even add removed items to the list
+    listed_layers = [row for row in reader if row[3] != 'removed']
+
+#: Layers are checked against AGOL and published concurrently, so a second
+#: entry with the same title wouldn't see the first one's item yet. Only
+#: publish the first entry for each title.
+layers = []
+duplicate_layers = []
+seen_titles = set()
+for row in listed_layers:
+    title = agol_title(row[1])
+    if title in seen_titles:
+        duplicate_layers.append(row)
+    else:
+        seen_titles.add(title)
+        layers.append(row)
+
+#: Get metadata for whole SDE, terms of use
+metadata_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'metadata.json')
+#: Nearly every entry gets looked up, so parse the whole file once up front
+metadata_store = MetadataStore(metadata_file_path, preload=True)
+
+with open(terms_of_use_path) as terms_file:
+    generic_terms_of_use = terms_file.read()
+
+#: Open the Pro project once and reuse it for every layer rather than
+#: re-reading the .aprx on each iteration
+proj = arcpy.mp.ArcGISProject(project_path)
+maps = {m.name: m for m in proj.listMaps()}
+if map_name not in maps:
+    raise ValueError(f'No map named {map_name} in {project_path}')
+agol_map = maps[map_name]
+
+#: Clear out the map and make sure it's in web mercator once, then save that
+#: definition to reset the map with before each layer
+for l in agol_map.listLayers():
+    agol_map.removeLayer(l)
+for t in agol_map.listTables():
+    agol_map.removeTable(t)
+empty_map_cim = agol_map.getDefinition('V2')
+if empty_map_cim.spatialReference['wkid'] != 3857:
+    print('changing map projection')
+    empty_map_cim.spatialReference = {'wkid':3857}
+    agol_map.setDefinition(empty_map_cim)
+
+print('describing layers')
+describe_cache, known_tables = describe_layers(sde_path, [layer[0] for layer in layers])
+
+updated_rows = {}
+
+#: arcpy's environment and messages are process-wide and it isn't thread-safe,
+#: so only one thread at a time gets to describe, project, or stage. Checking
+#: AGOL and uploading run concurrently with that.
+arcpy_lock = threading.Lock()
+
+#: Every layer should be logged to the csv, regardless of success or failure.
+#: Keep the log open for the whole run; line buffering still gets each entry
+#: onto disk as soon as it's written.
+#: Whatever happens, send the Sheets writes queued for layers that were
+#: already published so they aren't lost.
+try:
+    with open(log_path, 'a', newline='\n', buffering=1) as log_file, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=s.PUBLISH_WORKERS) as executor:
+        log_writer = csv.writer(log_file)
+        for entry in duplicate_layers:
+            print(f'{entry[0]} has the same title as an earlier entry; not publishing')
+            duplicate_entry = [entry[1], f'{entry[0]}: duplicate title in {list_csv}; not published']
+            try:
+                log_writer.writerow(duplicate_entry)
+            except IOError:
+                print(f'Error writing log file: {duplicate_entry}')
+        futures = [executor.submit(process_entry, entry) for entry in layers]
+        try:
+            for entry, future in zip(layers, futures):
+                log_entry, published = future.result()
+                #: Log to the csv first so the layer is recorded even if the
+                #: stewardship doc can't be read
+                if log_entry:
+                    try:
+                        log_writer.writerow(log_entry)
+                    except IOError:
+                        print(f'Error writing log file: {log_entry}')
+                if published:
+                    try:
+                        updated_rows[entry[0]] = log_gsheets(log_entry, gsheet_auth,
+                                                             (stewardship_sheet_key,
+                                                              agol_sheet_key))
+                    except Exception:
+                        print(f'Could not queue stewardship updates for {entry[0]}:')
+                        traceback.print_exc()
+        except BaseException:
+            #: Don't start publishing layers whose results would go unlogged
+            for future in futures:
+                future.cancel()
+            raise
+finally:
+    flush_gsheets(gsheet_auth, (stewardship_sheet_key, agol_sheet_key))
 
-# pprint.pprint(updated_rows)
 
 try:
     shutil.rmtree(temp_dir)
 except PermissionError:
     print(f'Could not remove temporary directory {temp_dir}. Please delete manually.')
-
-
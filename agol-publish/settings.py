@@ -8,3 +8,13 @@ GSHEET_AUTH = r'c:\gis\git\agol-open-data-toolbox\agol-publish\client_secret.jso
 #: Note: these currently point to testing sheets.
 STEWARDSHIP_SHEET_KEY = '1Qu60mevJHwCvBAWAk6bF2NhwEykh5znWInaGzsxWG1c'
 AGOL_SHEET_KEY = '1jPJcu3zLYvbaaksFEr_ySa1dreASEoGU15n3KcLdp0w'
+#: Number of layers to process at once. All arcpy work (projecting and
+#: staging) is still done one layer at a time.
+PUBLISH_WORKERS = 8
+#: Service definitions bigger than UPLOAD_PART_SIZE bytes are uploaded in parts,
+#: UPLOAD_THREADS parts at a time. Part size must be a multiple of 8 KiB.
+UPLOAD_PART_SIZE = 32 * 1024 * 1024
+UPLOAD_THREADS = 10
+#: Seconds to wait for AGOL to assemble a multi-part upload before failing the
+#: layer
+UPLOAD_COMMIT_TIMEOUT = 30 * 60
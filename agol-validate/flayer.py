@@ -18,76 +18,191 @@ import arcgis
 import getpass
 import datetime
 import csv
+import functools
+import gzip
 import logging
+import time
 import pandas as pd
+import requests
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+
+#: GIS connections by (portal path, user name), so creating another org for
+#: the same user doesn't prompt for a password and log in again
+_GIS_CACHE = {}
+
+#: How long (seconds) item usage is cached between runs
+USAGE_CACHE_EXPIRE = 24 * 60 * 60
 
 
 def usage_sum(df):
     '''
-    QnD sum of the 'Usage' series in a data frame
+    QnD sum of the 'Usage' series in a data frame. Sums the underlying numpy
+    array directly to skip pandas' Series overhead and returns a plain int
+    rather than a numpy scalar. Empty frames (no usage data) sum to 0.
+    '''
+    if df.empty or 'Usage' not in df:
+        return 0
+    return int(df['Usage'].to_numpy().sum())
+
+
+def retry(request, attempts=3):
+    '''
+    Call request(), retrying with a short backoff if it fails with a
+    connection/timeout error so a transient AGOL hiccup doesn't turn into an
+    'error' in the report. Any other error (or running out of attempts) is
+    raised.
     '''
-    return df['Usage'].sum()
+    for attempt in range(attempts):
+        try:
+            return request()
+        except requests.RequestException:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(2 ** attempt)
 
 
-def item_info(item, folder):
+@functools.lru_cache(maxsize=None)
+def _usage_cache(cache_dir):
+    '''
+    Open the on-disk usage cache in cache_dir the first time it's needed.
+    diskcache is only imported here so it isn't needed when caching is off.
+    '''
+    import diskcache
+
+    return diskcache.Cache(cache_dir)
+
+
+def data_requests_1Y(item, cache_dir=None):
+    '''
+    Total data requests for an item over the last year. Usage is slow to
+    fetch and barely changes between runs, so if cache_dir is given the total
+    is cached on disk there for USAGE_CACHE_EXPIRE seconds. The cache key
+    includes the item's modified time so edited items are fetched again.
+    '''
+    if not cache_dir:
+        return usage_sum(retry(lambda: item.usage('1Y')))
+
+    cache = _usage_cache(cache_dir)
+    key = ('usage_1Y', item.itemid, item.modified)
+    total = cache.get(key)
+    if total is None:
+        total = usage_sum(retry(lambda: item.usage('1Y')))
+        cache.set(key, total, expire=USAGE_CACHE_EXPIRE)
+    return total
+
+
+def group_titles(item, cache=None):
+    '''
+    Return a tuple of the titles of the groups item is shared with. If a
+    cache dictionary ({itemid:titles}) is given, the titles are only fetched
+    from AGOL the first time they're asked for. Errors aren't cached, so a
+    failed lookup is tried again next time.
+    '''
+    titles = cache.get(item.itemid) if cache is not None else None
+    if titles is None:
+        shared_groups = retry(lambda: item.shared_with).get('groups', [])
+        titles = tuple(g.title for g in shared_groups)
+        if cache is not None:
+            cache[item.itemid] = titles
+    return titles
+
+
+#: The few fields of a search result that the tag reports need. Has the same
+#: .title/.tags attributes as a full item.
+ItemSummary = namedtuple('ItemSummary', ['itemid', 'title', 'tags'])
+
+
+#: Columns of the feature service info, in the order item_info() returns them
+ITEM_COLUMNS = ('title', 'itemid', 'owner', 'folder', 'groups', 'tags',
+                'authoritative', 'modified', 'views', 'size',
+                'data_requests_1Y', 'open_data')
+
+#: Columns of the feature service report; sizeMB and credits are derived from
+#: size for the whole frame at once
+REPORT_COLUMNS = ('title', 'itemid', 'owner', 'folder', 'groups', 'tags',
+                  'authoritative', 'modified', 'views', 'sizeMB', 'credits',
+                  'data_requests_1Y', 'open_data')
+
+
+def item_info(item, folder, usage_cache_dir=None, group_cache=None):
     '''
     Given an item object and a string representing the name of the folder it
-    resides in, item_info builds a dictionary containing pertinent info about
-    that item.
+    resides in, item_info builds a tuple containing pertinent info about
+    that item, ordered to match ITEM_COLUMNS. Usage is cached in
+    usage_cache_dir if it's given (see data_requests_1Y()), and group titles
+    in group_cache (see group_titles()).
     '''
-    item_dict = {}
-    item_dict['itemid'] = item.itemid
-    item_dict['title'] = item.title
-    item_dict['owner'] = item.owner
-    if folder:
-        item_dict['folder'] = folder
-    else:
-        item_dict['folder'] = '_root'
-    item_dict['views'] = item.numViews
-    item_dict['modified'] = datetime.datetime.fromtimestamp(item.modified/1000).strftime('%Y-%m-%d %H:%M:%S')
-    item_dict['authoritative'] = item.content_status
-    
+    if not folder:
+        folder = '_root'
+
     #: Sometimes we get a permission denied error on group listing, so we wrap
     #: it in a try/except to keep moving
-    item_dict['open_data'] = 'no'
     try:
-        gnames = []
-        for g in item.shared_with['groups']:
-            gnames.append(g.title)
-            if 'Utah SGID' in g.title:
-                item_dict['open_data'] = 'yes'
+        gnames = group_titles(item, group_cache)
+        if any('Utah SGID' in gname for gname in gnames):
+            open_data = 'yes'
+        else:
+            open_data = 'no'
         groups = ', '.join(gnames)
-    except:
+    except Exception as e:
+        logging.warning('Could not get groups for {} ({}): {}'.format(item.title, item.itemid, e))
         groups = 'error'
-        item_dict['open_data'] = 'unknown'
-    item_dict['groups'] = groups
-    
-    tag_list = []
-    for t in item.tags:
-        tag_list.append(t)
-    item_dict['tags'] = ', '.join(tag_list)
-    mb = item.size/1024/1024
-    item_dict['sizeMB'] = mb
-    item_dict['credits'] = mb*.24
-    
+        open_data = 'unknown'
+
     #: Sometimes data usage also gives an error, so try/except that as well
     try:
-        item_dict['data_requests_1Y'] = usage_sum(item.usage('1Y'))
-    except:
-        item_dict['data_requests_1Y'] = 'error'
+        data_requests = data_requests_1Y(item, usage_cache_dir)
+    except Exception as e:
+        logging.warning('Could not get usage for {} ({}): {}'.format(item.title, item.itemid, e))
+        data_requests = 'error'
 
-    return item_dict
+    #: modified (epoch milliseconds) and size (bytes) are raw; they're
+    #: converted for the whole frame at once in get_feature_services_info
+    return (item.title, item.itemid, item.owner, folder, groups,
+            ', '.join(item.tags), item.content_status, item.modified,
+            item.numViews, item.size, data_requests, open_data)
 
 
 def dict_writer(dictionary, out_path, header_row=None):
-    with open(out_path, 'w', newline='') as out_file:
+    #: Big dictionaries compress well; level 1 is cheap on the CPU
+    if out_path.endswith('.gz'):
+        out_file = gzip.open(out_path, 'wt', newline='', compresslevel=1)
+    else:
+        out_file = open(out_path, 'w', newline='', buffering=1<<20)
+    with out_file:
         writer = csv.writer(out_file)
         if header_row:
             writer.writerow(header_row)
-        for key in dictionary:
-            row = [key]
-            row.extend(dictionary[key])
-            writer.writerow(row)
+        writer.writerows([key, *values] for key, values in dictionary.items())
+
+
+def frame_writer(df, out_path):
+    '''
+    Write a data frame to out_path, picking the format from the extension.
+    .parquet (zstd-compressed), .feather, and .csv are much faster to write
+    than excel; anything else is written as an .xlsx file for humans, streamed
+    row by row by xlsxwriter to keep memory use flat.
+    '''
+    if out_path.endswith(('.parquet', '.feather')):
+        #: Arrow can't store a column that mixes types, like the usage counts
+        #: that hold 'error' when a lookup failed, so store those as text
+        mixed = [column for column in df.select_dtypes(include='object')
+                 if df[column].map(type).nunique() > 1]
+        df = df.astype({column: str for column in mixed})
+    if out_path.endswith('.parquet'):
+        df.to_parquet(out_path, compression='zstd')
+    elif out_path.endswith('.feather'):
+        df.to_feather(out_path)
+    elif out_path.endswith('.csv'):
+        df.to_csv(out_path, index=False)
+    else:
+        with pd.ExcelWriter(out_path, engine='xlsxwriter',
+                            engine_kwargs={'options': {'constant_memory': True}}) as writer:
+            df.to_excel(writer, index=False)
 
 
 def tag_case(tag, uppercased, articles):
@@ -111,13 +226,14 @@ def tag_case(tag, uppercased, articles):
     new_words = []
     for word in tag.split():
         cleaned_word = word.replace('.', '')
+        lowered_word = cleaned_word.lower()
         
         #: Upper case specified words:
-        if cleaned_word.lower() in uppercased:
+        if lowered_word in uppercased:
             new_words.append(cleaned_word.upper())
         #: Lower case articles/conjunctions 
-        elif cleaned_word.lower() in articles:
-            new_words.append(cleaned_word.lower())
+        elif lowered_word in articles:
+            new_words.append(lowered_word)
         #: Title case everything else
         else:
             new_words.append(cleaned_word.title())
@@ -126,61 +242,120 @@ def tag_case(tag, uppercased, articles):
 
 class org:
 
-    #: A dictionary of tags and a list of items that are tagged thus
-    #: {tag:[item1, item2, ...]}
-    tags_and_items = {}
+    #: Tags or words that should be uppercased, saved as lower to check against
+    uppercased_tags = frozenset(['2g', '3g', '4g', 'agrc', 'aog', 'at&t', 'blm', 'brat', 'caf', 'cdl', 'daq', 'dfcm', 'dfirm', 'dwq', 'e911', 'ems', 'fae', 'fcc', 'fema', 'gcdb', 'gis', 'gnis', 'hava', 'huc', 'lir', 'lrs', 'lte', 'luca', 'mrrc', 'nca', 'ng911', 'nox', 'npsbn', 'ntia', 'nwi', 'plss', 'pm10', 'psap', 'sbdc', 'sbi', 'sgid', 'sitla', 'sligp', 'trax', 'uca', 'udot', 'ugs', 'uhp', 'uic', 'us', 'usdw', 'usfs', 'usfws', 'usps', 'ustc', 'ut', 'uta', 'vcp', 'vista', 'voc'])
 
-    #: A list of tags sorted alphabetically
-    sorted_tags = []
+    #: Articles that should be left lowercase.
+    articles = frozenset(['a', 'the', 'of', 'is', 'in'])
 
-    #: A list of dictionaries that hold info about each item. As all 
-    #: dictionaries from item_info() will have the same keys, this list of
-    #: dictionaries can easily be converted to a pandas dataframe.
-    feature_services = []
+    #: Tags that should be deleted
+    tags_to_delete = frozenset(['.sd', 'service definition'])
 
-    #: A list of feature service item objects generated by trawling all of 
-    #: the user's folders
-    feature_service_items = []
+    #: Lower-cased tags and their correct spelling
+    tag_rewrites = {'sgid': 'SGID', 'agrc': 'AGRC', 'utah': 'Utah'}
 
-    #: A dictionary of duplicate tags. The key is a lowercased check tag, and 
-    #: the value is a list of duplicate tags when ignoring case.
-    duplicate_tags = {}
+    #: Number of items to get info for at once in get_feature_services_info
+    info_workers = 16
 
-    #: Tags or words that should be uppercased, saved as lower to check against
-    uppercased_tags = ['2g', '3g', '4g', 'agrc', 'aog', 'at&t', 'blm', 'brat', 'caf', 'cdl', 'daq', 'dfcm', 'dfirm', 'dwq', 'e911', 'ems', 'fae', 'fcc', 'fema', 'gcdb', 'gis', 'gnis', 'hava', 'huc', 'lir', 'lrs', 'lte', 'luca', 'mrrc', 'nca', 'ng911', 'nox', 'npsbn', 'ntia', 'nwi', 'plss', 'pm10', 'psap', 'sbdc', 'sbi', 'sgid', 'sitla', 'sligp', 'trax', 'uca', 'udot', 'ugs', 'uhp', 'uic', 'us', 'usdw', 'usfs', 'usfws', 'usps', 'ustc', 'ut', 'uta', 'vcp', 'vista', 'voc']
+    #: IANA time zone to report item modified dates in (handles DST)
+    time_zone = 'America/Denver'
 
-    #: Articles that should be left lowercase.
-    articles = ['a', 'the', 'of', 'is', 'in']
+    #: Number of tag updates to send to AGOL at once in tag_fixer
+    update_workers = 8
 
-    #: Tags that should be deleted
-    tags_to_delete = ['.sd', 'service definition']
+    #: Maximum number of tag updates to start per second, to stay under
+    #: AGOL's rate limits
+    updates_per_second = 10
 
 
-    def __init__(self, path, user_name):
+    def __init__(self, path, user_name, usage_cache_dir=None):
         logging.info('==========')
         logging.info('Portal: {}'.format(path))
         logging.info('User: {}'.format(user_name))
         logging.info('==========')
 
+        #: A dictionary of tags and a list of items that are tagged thus
+        #: {tag:[item1, item2, ...]}
+        self.tags_and_items = {}
+
+        #: A list of tags sorted alphabetically
+        self.sorted_tags = []
+
+        #: A dictionary of lower-cased tags and the actual tags that match
+        #: them when lower-cased: {check_tag:[tag, Tag, TAG...]}
+        self.lowercased_index = {}
+
+        #: A dictionary of duplicate tags. The key is a lowercased check tag,
+        #: and the value is a list of duplicate tags when ignoring case.
+        self.duplicate_tags = {}
+
+        #: Memoized results of _cased_tag(): {tag:properly-cased tag}
+        self._cased_tags = {}
+
+        #: Info about each item, stored by column: {column:[item1 value, ...]}.
+        #: Columns match ITEM_COLUMNS so this converts directly to a pandas
+        #: dataframe.
+        self.feature_services = {column: [] for column in ITEM_COLUMNS}
+
+        #: A list of feature service item objects owned by the user
+        self.feature_service_items = []
+
+        #: The title of the folder holding each item: {itemid:folder title}.
+        #: Items in the root folder map to None.
+        self._item_folder = {}
+
+        #: Directory to cache item usage in between runs; None to not cache
+        self.usage_cache_dir = usage_cache_dir
+
+        #: Titles of the groups each item is shared with, so
+        #: get_feature_services_info and tag_fixer only ask AGOL once per
+        #: item: {itemid:(group title, ...)}
+        self._group_titles = {}
+
         self.user_name = user_name
-        self.gis = arcgis.gis.GIS(path, user_name,
+        key = (path, user_name)
+        if key not in _GIS_CACHE:
+            gis = arcgis.gis.GIS(path, user_name,
                        getpass.getpass("{}'s password: ".format(user_name)))
+            #: Allow enough pooled connections for the concurrent requests
+            #: made by get_feature_services_info and tag_fixer
+            session = getattr(gis._con, '_session', None)
+            if session is not None:
+                session.mount('https://', HTTPAdapter(pool_connections=32,
+                                                      pool_maxsize=32))
+            _GIS_CACHE[key] = gis
+        self.gis = _GIS_CACHE[key]
+
+        #: Get all the Feature Service item objects owned by the user in a
+        #: single search rather than listing each folder separately. The
+        #: portal filters on type, so everything returned is a Feature Service.
+        print('Getting item objects...')
+        query = 'owner:{} AND type:"Feature Service"'.format(self.user_name)
+        self.feature_service_items = self.gis.content.search(query=query,
+                                                             max_items=10000)
 
-        #: Get all the Feature Service item objects in the user's folders
-        user_item = self.gis.users.me
+        #: Items only know their folder's id; map them to titles now so the
+        #: folders don't have to be fetched again later
+        folder_titles = {folder['id']: folder['title']
+                         for folder in self.gis.users.me.folders}
+        self._item_folder = {item.itemid: folder_titles.get(item.ownerFolder)
+                             for item in self.feature_service_items}
 
-        #: Build list of folders. 'None' gives us the root folder.
-        print('Getting {}\'s folders...'.format(self.user_name))
-        folders = [None]
-        for folder in user_item.folders:
-            folders.append(folder['title'])
 
-        #: Get info for every item in every folder
-        print('Getting item objects...')
-        for folder in folders:
-            for item in user_item.items(folder, 1000):
-                if item.type == 'Feature Service':
-                    self.feature_service_items.append(item)
+    def search_item_summaries(self, query, page_size=100):
+        '''
+        Page through the portal's search endpoint for query, yielding an
+        ItemSummary for each result as each page comes in rather than building
+        full item objects for everything up front.
+        '''
+        start = 1
+        while start != -1:
+            page = retry(lambda: self.gis._con.get('search', {
+                'q': query, 'start': start, 'num': page_size,
+                'sortField': 'created', 'f': 'json'}))
+            for result in page['results']:
+                yield ItemSummary(result['id'], result['title'], result['tags'])
+            start = page['nextStart']
 
 
     def get_users_tags_and_item_names(self, method='owner', out_path=None):
@@ -200,70 +375,79 @@ class org:
         '''
 
         if method == 'owner':
-            items = self.gis.content.search(query='owner:'+self.user_name, 
-                                            item_type='Feature Layer', 
-                                            max_items=1000)
-
-            #: Create dictionary of tags and a list of items that are tagged thus
+            items = self.search_item_summaries(
+                'owner:{} AND type:"Feature Service"'.format(self.user_name))
             print('Creating list of tags and the items associated with them...')
-            for item in items:
-                for tag in item.tags:
-                    if not tag in self.tags_and_items:
-                        self.tags_and_items[tag] = [item]
-                    else:
-                        self.tags_and_items[tag].append(item)
-
         elif method == 'folder':
-            for item in self.feature_service_items:
-                for tag in item.tags:
-                    if not tag in self.tags_and_items:
-                        self.tags_and_items[tag] = [item]
-                    else:
-                        self.tags_and_items[tag].append(item)
+            items = self.feature_service_items
+        else:
+            items = []
 
+        #: Create dictionary of tags and a list of items that are tagged thus
+        tags_and_items = defaultdict(list, self.tags_and_items)
+        for item in items:
+            for tag in item.tags:
+                tags_and_items[tag].append(item)
+        self.tags_and_items = dict(tags_and_items)
 
         #: For sanity's sake (this is in sigmund, after all), sort by name
         self.sorted_tags = sorted(self.tags_and_items)
 
+        #: Index the tags by their lower-cased version for finding duplicates
+        lowercased_index = defaultdict(list)
+        for tag in self.tags_and_items:
+            lowercased_index[tag.lower()].append(tag)
+        self.lowercased_index = dict(lowercased_index)
+
         #: Create a dictionary based on tags returning a list of the number of
         #: items referenced by that tag and their titles for csv output
         #: {tag: [3, foo, bar, baz], ...}
         length_dict = {}
-        longest_tag_list = 0  #: For creating tag indices in csv header
         for tag in self.tags_and_items:
             item_titles = [item.title for item in self.tags_and_items[tag]]
             #: First item in the list is the number of items with that tag
             length_dict[tag] = [len(item_titles)]
-            #: Update longest_tag_list if needed
-            if len(item_titles) > longest_tag_list:
-                longest_tag_list = len(item_titles)
             #: Append the list of titles to the list
             length_dict[tag].extend(sorted(item_titles))
 
+        #: For creating tag indices in csv header
+        longest_tag_list = max((len(items) for items
+                                in self.tags_and_items.values()), default=0)
+
         if out_path:
             header_row = ['tag', 'count']
             header_row.extend([f'tag_{i}' for i in range(0, longest_tag_list)])
             dict_writer(length_dict, out_path, header_row)
 
 
+    def _ensure_tag_index(self):
+        '''
+        Populate self.tags_and_items and the indices built from it
+        (self.sorted_tags, self.lowercased_index) if they are not already
+        populated, so the tag reports all share one pass over the items.
+        '''
+        if not self.tags_and_items:
+            self.get_users_tags_and_item_names()
+
+
     def tag_cloud(self, out_path=None):
         '''
-        Create a list of all tags in all the items in the user's folders
-        (self.feature_services). If out_path is specified, the tags are sorted,
-        added to a pandas series, and then written out as an .xls to out_path.
+        Create a list of all tags in all the user's items
+        (self.tags_and_items). If out_path is specified, the sorted tags are
+        written to out_path: one per line if it's a .txt file, otherwise with
+        frame_writer().
         '''
 
-        tags = []
-        for item in self.feature_service_items:
-            for tag in item.tags:
-                if tag not in tags:
-                    tags.append(tag)
+        self._ensure_tag_index()
 
-        # print(sorted(tags))
-        tag_series = pd.Series(sorted(tags))
+        tag_series = pd.Series(self.sorted_tags)
         print(tag_series)
         if out_path:
-            tag_series.to_excel(out_path)
+            if out_path.endswith('.txt'):
+                with open(out_path, 'w') as out_file:
+                    out_file.write('\n'.join(tag_series))
+            else:
+                frame_writer(tag_series.to_frame('tag'), out_path)
 
 
     def get_tags_with_leading_spaces(self, out_path=None):
@@ -276,18 +460,14 @@ class org:
 
         #: Populate the dictionary of tags and associated items if it is not
         #: already populated.
-        if not self.tags_and_items:
-            self.get_users_tags_and_item_names()
+        self._ensure_tag_index()
 
         print('Saving items with leading-space tags to {}...'.format(out_path))
-        leading_space_tagged = {}
-        for tag in self.tags_and_items:
-            if tag.startswith(' '):
-                for item in self.tags_and_items[tag]:
-                    if item.title not in leading_space_tagged:
-                        leading_space_tagged[item.title] = [tag]
-                    else:
-                        leading_space_tagged[item.title].append(tag)
+        leading_space_tagged = defaultdict(list)
+        for tag, items in self.tags_and_items.items():
+            if tag[:1] == ' ':
+                for item in items:
+                    leading_space_tagged[item.title].append(tag)
 
         if out_path:
             dict_writer(leading_space_tagged, out_path)
@@ -302,51 +482,65 @@ class org:
         Write dictionary to out_path if specified.
         '''
         #: Method:
-        #: For each tag, create a lowercased check_tag version. If check_tag
-        #: hasn't been seen before, add it to dictionary of seen tags with value
-        #: of 1-element list of the actual tag. If it has been seen (check_tag
-        #: is in the dictionary keys), add this new actual tag to the list of
-        #: tags associated with the check_tag key. Afterwards, any value (list
-        #: of tags) in dictionary with len > 1 indicates functionally duplicate
-        #: tags.
+        #: self.lowercased_index holds every lower-cased check_tag and the list
+        #: of actual tags that match it. Any value (list of tags) with len > 1
+        #: indicates functionally duplicate tags.
 
         #: Populate the dictionary of tags and associated items if it is not
         #: already populated.
-        if not self.tags_and_items:
-            self.get_users_tags_and_item_names()
-
-        #: Dictionary of lower-cased tag and all other tags that match when 
-        #: lower-cased: {check_tag:[tag, tag, tag...]}
-        tags_by_check_tag = {}
-
-        #: Used to generate header row indices
-        longest_tag_list = 0
-        
-        #: Start checking for dupes
-        for tag in self.tags_and_items:
-            check_tag = tag.lower()
-
-            #: What is useful information to report about duplicate tags?
-            related_itemids = [item.itemid for item in self.tags_and_items[tag]]
-            if check_tag in tags_by_check_tag:
-                tags_by_check_tag[check_tag].append(tag)
-                if len(tags_by_check_tag[check_tag]) > longest_tag_list:
-                    longest_tag_list = len(tags_by_check_tag[check_tag])
-            else:
-                tags_by_check_tag[check_tag] = [tag]
+        self._ensure_tag_index()
 
         #: Create dictionary of duplicates where len(tag_list) > 1
         self.duplicate_tags = {check_tag : tag_list
                                 for check_tag, tag_list
-                                in tags_by_check_tag.items()
+                                in self.lowercased_index.items()
                                 if len(tag_list) > 1}
 
+        #: Used to generate header row indices
+        longest_tag_list = max((len(tag_list) for tag_list
+                                in self.duplicate_tags.values()), default=0)
+
         if out_path:
             header_row = ['lowercase_check_tag']
             header_row.extend([f'tag_{i}' for i in range(0, longest_tag_list)])
             dict_writer(self.duplicate_tags, out_path, header_row)
 
 
+    def _cased_tag(self, tag):
+        '''
+        Return the properly-cased version of a (stripped) tag. Common tags
+        like SGID/AGRC/Utah have a fixed spelling; everything else goes
+        through tag_case(). Results are memoized because the same tags show up
+        on many items.
+        '''
+        cased_tag = self._cased_tags.get(tag)
+        if cased_tag is None:
+            cased_tag = self.tag_rewrites.get(tag.lower())
+            if cased_tag is None:
+                cased_tag = tag_case(tag, self.uppercased_tags, self.articles)
+            self._cased_tags[tag] = cased_tag
+        return cased_tag
+
+
+    def _tags_need_fixing(self, tags, title, title_words):
+        '''
+        Return True if tag_fixer's per-tag checks would change any of tags:
+        a tag with extra whitespace, a tag to delete, a tag that's in the
+        title, a mis-cased tag, or a duplicate tag.
+        '''
+        #: Cheap whole-set checks first: duplicates, single-word tags in the
+        #: title, and tags to delete
+        tag_set = set(tags)
+        if (len(tag_set) != len(tags)
+                or tag_set & title_words
+                or {tag.lower() for tag in tag_set} & self.tags_to_delete):
+            return True
+        return any(tag != tag.strip()
+                   or (' ' in tag and tag in title)
+                   or self._cased_tag(tag) != tag
+                   for tag in tag_set)
+
+
     def tag_fixer(self):
         '''
         Automagically fix tags with spaces, certain capitalized tags, and 
@@ -360,12 +554,28 @@ class org:
         total = len(self.feature_service_items)
         counter = 0
         updated = 0
+
+        #: (item, title, new_tags) for every item whose tags need updating
+        pending_updates = []
         for item in self.feature_service_items:
             counter += 1
 
-            orig_tags = [t.strip() for t in item.tags]
+            #: Bind the item's REST-backed properties once per item
+            tags = list(item.tags)
+            title = item.title
+            title_words = set(title.split())
+
+            #: Most items' tags are already clean on re-runs; keep them as-is
+            #: and skip straight to the category check
+            if self._tags_need_fixing(tags, title, title_words):
+                orig_tags = [t.strip() for t in tags]
+                new_tags = []
+            else:
+                orig_tags = []
+                new_tags = list(tags)
 
-            new_tags = []
+            #: Mirrors new_tags for constant-time duplicate checks
+            new_tags_set = set()
 
             #: Evaluate existing tags: upercase SGID and AGRC, fix/keep Utah
             #: if not in title, remove if in list of bad tags, remove if in
@@ -381,48 +591,42 @@ class org:
                 #: to be checked later.
 
                 #: single-word tag in title
-                single_word_tag_in_title = False
-                if orig_tag in item.title.split():
-                    single_word_tag_in_title = True
+                single_word_tag_in_title = orig_tag in title_words
                 #: multi-word tag in title
-                multi_word_tag_in_title = False
-                if ' ' in orig_tag and orig_tag in item.title:
-                    multi_word_tag_in_title = True
+                multi_word_tag_in_title = ' ' in orig_tag and orig_tag in title
 
                 #: operate on lower case to fix any weird mis-cased tags
                 cleaned_tag = orig_tag.lower()
 
-                #: Run checks on the tags. A check that modifies the tag should
-                #: append it to new_tags. A check that removes unwanted tags
+                #: Run checks on the tags. A check that removes unwanted tags
                 #: should just pass. If a tag passes all the checks, it gets
                 #: properly cased and added to new_tags (the else clause).
 
-                #: Fix/keep 'Utah' if it's not in the title
-                if cleaned_tag == 'utah' and orig_tag not in item.title.split():
-                    new_tags.append('Utah')
                 #: Don't add to new_tags if it should be deleted
-                elif cleaned_tag in self.tags_to_delete:
+                if cleaned_tag in self.tags_to_delete:
                     pass
-                #: Don't add if it's in the title
+                #: Don't add if it's in the title (this also drops 'Utah' when
+                #: it's in the title)
                 elif single_word_tag_in_title or multi_word_tag_in_title:
                     pass
                 #: Otherwise, add the tag (properly-cased)
                 else:
-                    cased_tag = tag_case(orig_tag, 
-                                         self.uppercased_tags, 
-                                         self.articles)
-                    if cased_tag not in new_tags:
+                    cased_tag = self._cased_tag(orig_tag)
+                    if cased_tag not in new_tags_set:
+                        new_tags_set.add(cased_tag)
                         new_tags.append(cased_tag)
             
             #: Add the category tag
             groups = []
             #: Wrap in try/except because some groups fail for some odd reason
             try:
-                for g in item.shared_with['groups']:
-                    groups.append(g.title)
-            except:
-                failed_group_items.append(item.title)
+                groups = group_titles(item, self._group_titles)
+            except Exception as e:
+                logging.warning('Could not get groups for {}: {}'.format(title, e))
+                failed_group_items.append(title)
 
+            #: Items are only shared to one SGID category group, so stop at
+            #: the first one
             for group in groups:
                 if 'Utah SGID' in group:
                     category = group.split('Utah SGID ')[-1]
@@ -435,23 +639,46 @@ class org:
                     #: Make sure it's got SGID in it's tags
                     if 'SGID' not in new_tags:
                         new_tags.append('SGID')
+                    break
             
-            #: Only update if the tags have changed
-            if sorted(item.tags) != sorted(new_tags):
-                #: Update the item
-                print('\nUpdating {} ({} of {})'.format(item.title, counter, total))
-                print('Old tags: {}'.format(item.tags))
+            #: Only update if the tags have changed. Compare sorted lists
+            #: rather than sets so removing a duplicate tag counts as a change.
+            if sorted(tags) != sorted(new_tags):
+                #: Queue the item to be updated once all items are evaluated
+                print('\nWill update {} ({} of {})'.format(title, counter, total))
+                print('Old tags: {}'.format(tags))
                 print('New tags: {}'.format(new_tags))
-                logging.info('Old tags <{}>: {}'.format(item.title, item.tags))
-                logging.info('New tags <{}>: {}'.format(item.title, new_tags))
-                item.update({'tags':new_tags})
-                updated += 1
+                logging.info('Old tags <{}>: {}'.format(title, tags))
+                logging.info('New tags <{}>: {}'.format(title, new_tags))
+                pending_updates.append((item, title, new_tags))
             else:
-                print('\nNot updating {} — Tags are the same ({} of {})'.format(item.title, counter, total))
-                print('Old tags: {}'.format(item.tags))
+                print('\nNot updating {} — Tags are the same ({} of {})'.format(title, counter, total))
+                print('Old tags: {}'.format(tags))
                 print('New tags: {}'.format(new_tags))
-                logging.info('Old tags <{}>: {}'.format(item.title, item.tags))
-                logging.info('New tags <{}>: {}'.format(item.title, new_tags))
+                logging.info('Old tags <{}>: {}'.format(title, tags))
+                logging.info('New tags <{}>: {}'.format(title, new_tags))
+
+        #: Send all the updates after evaluating so the evaluation isn't held
+        #: up by AGOL. The updates are independent, so send several at once.
+        print('\nUpdating {} items...'.format(len(pending_updates)))
+        with ThreadPoolExecutor(max_workers=self.update_workers) as executor:
+            futures = {}
+            for item, title, new_tags in pending_updates:
+                futures[executor.submit(item.update, {'tags':new_tags})] = (title, new_tags)
+                #: Space out the requests so a burst doesn't get throttled
+                time.sleep(1 / self.updates_per_second)
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                title, new_tags = futures[future]
+                try:
+                    success = future.result()
+                except Exception as e:
+                    logging.warning('Error updating tags <{}>: {}'.format(title, e))
+                    success = False
+                if success:
+                    updated += 1
+                else:
+                    tqdm.write('Failed to update tags for {}'.format(title))
+                    logging.info('Failed to update tags <{}>: {}'.format(title, new_tags))
 
         print('\nUpdated {} of {} items'.format(updated, total))
         if failed_group_items:
@@ -465,34 +692,37 @@ class org:
 
     def get_feature_services_info(self, out_path=None):
         '''
-        Creates a list of dictionaries holding information about each Feature 
-        Service in every folder in an AGOL account and saves the list to an
-        excel file.
+        Collects information about each Feature Service in every folder in an
+        AGOL account, column by column, and saves it to out_path as parquet,
+        feather, or excel depending on its extension.
         '''
 
         print('Creating item information...')
-        user_item = self.gis.users.me
-
-        #: Build list of folders. 'None' gives us the root folder.
-        folders = [None]
-        for folder in user_item.folders:
-            folders.append(folder['title'])
-
-        #: Get info for every item in every folder
-        for folder in folders:
-            for item in user_item.items(folder, 1000):
-                if item.type == 'Feature Service':
-                    print(item.title)
-                    self.feature_services.append(item_info(item, folder))
+
+        #: Get info for every item found in __init__. item_info() is almost
+        #: all waiting on AGOL requests, so run several at once.
+        item_folders = [(item, self._item_folder[item.itemid])
+                        for item in self.feature_service_items]
+        with ThreadPoolExecutor(max_workers=self.info_workers) as executor:
+            infos = executor.map(lambda pair: item_info(*pair, self.usage_cache_dir,
+                                                        self._group_titles),
+                                 item_folders)
+            for info in tqdm(infos, total=len(item_folders)):
+                tqdm.write(info[0])
+                for column, value in zip(ITEM_COLUMNS, info):
+                    self.feature_services[column].append(value)
         
-        #: Make a dataframe with properly ordered column names (dictionaries 
-        #: are unordered) and then save that as an excel file.
-        items_df = pd.DataFrame.from_records(self.feature_services, columns = [
-                    'title', 'itemid', 'owner', 'folder', 'groups', 'tags',
-                    'authoritative', 'modified', 'views', 'sizeMB', 'credits',
-                    'data_requests_1Y', 'open_data'])
+        #: Make a dataframe with properly ordered column names and then save
+        #: it.
+        items_df = pd.DataFrame(self.feature_services, columns=ITEM_COLUMNS)
+        items_df['modified'] = (pd.to_datetime(items_df['modified'], unit='ms', utc=True)
+                                .dt.tz_convert(self.time_zone)
+                                .dt.strftime('%Y-%m-%d %H:%M:%S'))
+        items_df['sizeMB'] = items_df['size'] / (1024 * 1024)
+        items_df['credits'] = items_df['sizeMB'] * .24
+        items_df = items_df[list(REPORT_COLUMNS)]
         if out_path:
-            items_df.to_excel(out_path)
+            frame_writer(items_df, out_path)
 
 
 if __name__ == '__main__':
@@ -506,12 +736,13 @@ if __name__ == '__main__':
     logging.info('Start: {}'.format(now))
 
     spaces_out = r'c:\temp\agol_spaced.csv'
-    items_out = r'c:\temp\agol_layers_postshelf.xls'
+    items_out = r'c:\temp\agol_layers_postshelf.xlsx'
     tags_out = r'c:\temp\agol_tags_and_items.csv'
-    tag_cloud_out = r'c:\temp\agol_tag_cloud.xls'
+    tag_cloud_out = r'c:\temp\agol_tag_cloud.xlsx'
     tags_items_out = r'c:\temp\agol_tags_items_2020-01-27.csv'
     dupe_tags_out = r'c:\temp\agol_tags_dupes.csv'
-    agrc = org('https://www.arcgis.com', 'UtahAGRC')
+    agrc = org('https://www.arcgis.com', 'UtahAGRC',
+               usage_cache_dir=r'c:\temp\agol_cache')
     agrc.get_users_tags_and_item_names('folder', tags_out)
     # agrc.get_tags_with_leading_spaces(spaces_out)
     # agrc.get_feature_services_info(items_out)